@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 """switchmate.py
 
@@ -8,7 +8,7 @@ Usage:
     ./switchmate.py scan [options]
     ./switchmate.py status [options]
     ./switchmate.py <mac_address> status [options]
-    ./switchmate.py <mac_address> switch (on | off)
+    ./switchmate.py <mac_address> switch (on | off) [--force]
     ./switchmate.py <mac_address> toggle
     ./switchmate.py <mac_address> battery-level
     ./switchmate.py <mac_address> debug
@@ -30,13 +30,21 @@ Commands:
 
 Options:
     -t <seconds>, --timeout=<seconds>  [default: 2]
-        Search for devices until this timeout.
+        Search for devices until this timeout. 0 searches until interrupted,
+        or until the requested device is found.
+    -p, --passive
+        Scan passively, without requesting scan responses from devices.
+    -f, --force
+        Write the new state without reading the current state first.
     -h, --help
         Show this help screen.
 """
 
-from __future__ import print_function
+import json
+import os
 import sys
+import tempfile
+import time
 
 from docopt import docopt
 from bluepy.btle import (
@@ -46,18 +54,6 @@ from bluepy.btle import (
 from binascii import hexlify
 from tabulate import tabulate
 
-
-def identity(x):
-    return x
-
-
-if sys.version_info >= (3,):
-    # In Python 3 we are already dealing with bytes,
-    # so just return the original value.
-    get_byte = identity
-else:
-    get_byte = ord
-
 # firmware == 2.99.15 (or higher?)
 SWITCHMATE_SERVICE = 'a22bd383-ebdd-49ac-b2e7-40eb55f5d0ab'
 
@@ -66,28 +62,139 @@ BRIGHT_STATE_HANDLE = 0x30
 
 ORIGINAL_MODEL_STRING_HANDLE = 0x14
 
+STATE_OFF = b'\x00'
+STATE_ON = b'\x01'
+
 SERVICES_AD_TYPE = 0x07
 MANUFACTURER_DATA_AD_TYPE = 0xff
 
+SCAN_SLICE_SECONDS = 0.5
+
+PRINTABLE_BYTES = bytes(range(32, 127))
+
+CACHE_FILE = os.path.expanduser('~/.switchmate_cache.json')
+
+# Friendlier messages for known bluepy errors, matched by substring.
+ERROR_MESSAGES = (
+    ('disconnected', 'ERROR: Device disconnected.'),
+    (
+        'failed to connect',
+        'ERROR: Failed to connect to device. '
+        'Try running switchmate with sudo.'
+    ),
+)
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_cache(cache):
+    # Write a temporary file and move it into place, so that concurrent runs
+    # or an interrupted write never leave a half-written cache behind.
+    try:
+        cache_file = tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(CACHE_FILE),
+            prefix='.switchmate_cache.', suffix='.tmp', delete=False
+        )
+    except OSError:
+        return
+    try:
+        with cache_file:
+            json.dump(cache, cache_file)
+        os.replace(cache_file.name, CACHE_FILE)
+    except OSError:
+        try:
+            os.remove(cache_file.name)
+        except OSError:
+            pass
+
+
+def cached_handle(device, key, probe, refresh=False):
+    # Return (handle, from_cache) for the handle cached for this device under
+    # key, calling probe(device) to find it when it is missing or refresh is
+    # set.
+    cache = load_cache()
+    device_cache = cache.get(device.addr)
+    if not isinstance(device_cache, dict):
+        device_cache = cache[device.addr] = {}
+    handle = device_cache.get(key)
+    if not refresh and type(handle) is int:
+        return handle, True
+    handle = probe(device)
+    device_cache[key] = handle
+    save_cache(cache)
+    return handle, False
+
+
+def read_cached_handle(device, key, probe, is_valid=None):
+    # A cached handle can go stale, so if reading through one fails, or
+    # returns a value that is_valid rejects, probe for it again and retry
+    # once. Freshly probed handles and disconnects would only fail again, so
+    # those errors are raised as is.
+    handle, from_cache = cached_handle(device, key, probe)
+    try:
+        value = device.readCharacteristic(handle)
+    except BTLEException as ex:
+        if not from_cache or ex.code == BTLEException.DISCONNECTED:
+            raise
+    else:
+        if not from_cache or is_valid is None or is_valid(value):
+            return handle, value
+    handle, _ = cached_handle(device, key, probe, refresh=True)
+    return handle, device.readCharacteristic(handle)
+
+
+def is_switchmate(scan_entry):
+    service_uuid = scan_entry.getValueText(SERVICES_AD_TYPE)
+    return service_uuid == SWITCHMATE_SERVICE
+
 
 def get_switchmates(scan_entries, mac_address):
-    switchmates = []
+    switchmates = {}
     for scan_entry in scan_entries:
-        service_uuid = scan_entry.getValueText(SERVICES_AD_TYPE)
-        is_switchmate = service_uuid == SWITCHMATE_SERVICE
-        if not is_switchmate:
+        if not is_switchmate(scan_entry):
             continue
         if mac_address and scan_entry.addr == mac_address:
             return [scan_entry]
-        if scan_entry not in switchmates:
-            switchmates.append(scan_entry)
-    switchmates.sort(key=lambda sw: sw.addr)
-    return switchmates
+        switchmates.setdefault(scan_entry.addr, scan_entry)
+    return sorted(switchmates.values(), key=lambda sw: sw.addr)
+
+
+def scan_for_device(scanner, timeout, mac_address, passive=False):
+    # Process the scan in short slices so that we can stop as soon as the
+    # requested device has advertised, instead of waiting out the timeout.
+    # Like bluepy's own scan(), a timeout of 0 scans without a time limit.
+    scanner.clear()
+    scanner.start(passive=passive)
+    try:
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            slice_seconds = SCAN_SLICE_SECONDS
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                slice_seconds = min(slice_seconds, remaining)
+            scanner.process(slice_seconds)
+            if any(
+                scan_entry.addr == mac_address and is_switchmate(scan_entry)
+                for scan_entry in scanner.getDevices()
+            ):
+                break
+    finally:
+        scanner.stop()
+    return scanner.getDevices()
 
 
 def scan(
     start_msg, process_entry,
-    timeout=None, mac_address=None, success_msg=None
+    timeout=None, mac_address=None, success_msg=None, passive=False
 ):
     print(start_msg)
     sys.stdout.flush()
@@ -95,12 +202,18 @@ def scan(
     scanner = Scanner()
 
     try:
-        switchmates = get_switchmates(scanner.scan(timeout), mac_address)
+        if mac_address:
+            scan_entries = scan_for_device(
+                scanner, timeout, mac_address, passive
+            )
+        else:
+            scan_entries = scanner.scan(timeout, passive=passive)
+        switchmates = get_switchmates(scan_entries, mac_address)
     except BTLEException as ex:
         print(
             'ERROR: Could not complete scan.',
             'Try running switchmate with sudo.',
-            ex.message
+            ex
         )
         return
     except OSError as ex:
@@ -125,10 +238,8 @@ def debug_helper(device):
     for char in device.getCharacteristics():
         if char.supportsRead():
             val = char.read()
-            binary = False
-            for c in val:
-                if get_byte(c) < 32 or get_byte(c) > 126:
-                    binary = True
+            # Deleting every printable byte leaves only the binary ones.
+            binary = bool(val.translate(None, PRINTABLE_BYTES))
             if binary:
                 val = hexlify(val)
         output.append([
@@ -149,19 +260,38 @@ def is_original_device(device):
     return model == b'Original'
 
 
-def get_state_handle(device):
+def probe_state_handle(device):
     if is_original_device(device):
         return ORIGINAL_STATE_HANDLE
     else:
         return BRIGHT_STATE_HANDLE
 
 
-def switch(device, val):
-    state_handle = get_state_handle(device)
-    curr_val = device.readCharacteristic(state_handle)
+def is_state(value):
+    return value in (STATE_OFF, STATE_ON)
+
+
+def get_state_handle(device):
+    # Only probe the model on first use. Callers that read the state should
+    # use read_cached_handle() with is_state, which also checks the handle.
+    state_handle, _ = cached_handle(device, 'state_handle', probe_state_handle)
+    return state_handle
+
+
+def switch(device, val, force=False):
+    # Reading the current state costs a round-trip, so skip it when forcing
+    # an explicit state. Toggling always needs it. The read also checks the
+    # cached state handle, so forced writes trust the cache as is.
+    if force and val is not None:
+        state_handle = get_state_handle(device)
+        curr_val = None
+    else:
+        state_handle, curr_val = read_cached_handle(
+            device, 'state_handle', probe_state_handle, is_state
+        )
     if val is None:
-        val = b'\x01' if curr_val == b'\x00' else b'\x00'
-    val_num = get_byte(val[0])
+        val = STATE_ON if curr_val == STATE_OFF else STATE_OFF
+    val_num = val[0]
     val_text = ('off', 'on')[val_num]
     if curr_val != val:
         device.writeCharacteristic(state_handle, val, True)
@@ -176,20 +306,31 @@ def print_entry_state(entry, state_handle=None):
     print(entry.addr, ("off", "on")[val])
 
 
-def print_battery_level(device):
+def probe_battery_level_handle(device):
+    # Looking up the battery level characteristic by uuid requires a
+    # discovery pass, which is why its handle is cached.
     battery_level = AssignedNumbers.batteryLevel
-    level = device.getCharacteristics(uuid=battery_level)[0].read()
-    print('Battery level: {}%'.format(ord(level)))
+    return device.getCharacteristics(uuid=battery_level)[0].getHandle()
+
+
+def print_battery_level(device):
+    _, level = read_cached_handle(
+        device, 'battery_level_handle', probe_battery_level_handle
+    )
+    print('Battery level: {}%'.format(level[0]))
 
 
 def print_exception(ex):
-    if 'disconnected' in ex.message.lower():
-        print('ERROR: Device disconnected.')
-    else:
-        print('ERROR: ' + ex.message)
+    message = str(ex)
+    lower_message = message.lower()
+    for fragment, error_message in ERROR_MESSAGES:
+        if fragment in lower_message:
+            print(error_message)
+            return
+    print('ERROR: ' + message)
 
 
-if __name__ == '__main__':
+def main():
     arguments = docopt(__doc__)
 
     if arguments['help']:
@@ -197,12 +338,14 @@ if __name__ == '__main__':
         sys.exit()
 
     timeout = int(arguments['--timeout'])
+    passive = arguments['--passive']
 
     if arguments['scan']:
         scan(
             'Scanning...',
             success_msg='Found Switchmates:',
             timeout=timeout,
+            passive=passive,
             process_entry=lambda switchmate: print(switchmate.addr),
         )
         sys.exit()
@@ -212,6 +355,7 @@ if __name__ == '__main__':
         scan(
             'Looking for switchmate status...',
             timeout=timeout,
+            passive=passive,
             process_entry=print_entry_state,
             mac_address=mac_address,
         )
@@ -220,13 +364,7 @@ if __name__ == '__main__':
     try:
         device = Peripheral(mac_address, ADDR_TYPE_RANDOM)
     except BTLEException as ex:
-        if 'failed to connect' in ex.message.lower():
-            print(
-                'ERROR: Failed to connect to device.',
-                'Try running switchmate with sudo.',
-            )
-        else:
-            print('ERROR: ' + ex.message)
+        print_exception(ex)
         sys.exit(1)
     except OSError as ex:
         print(
@@ -242,20 +380,20 @@ if __name__ == '__main__':
             debug_helper(device)
             device.disconnect()
         except Exception as ex:
-            print('ERROR: Could not retrieve debug info.', ex.message)
+            print('ERROR: Could not retrieve debug info.', ex)
             sys.exit(1)
         else:
             sys.exit()
 
     if arguments['switch'] or arguments['toggle']:
         if arguments['on']:
-            val = b'\x01'
+            val = STATE_ON
         else:
-            val = b'\x00'
+            val = STATE_OFF
         if arguments['toggle']:
             val = None
         try:
-            switch(device, val)
+            switch(device, val, arguments['--force'])
         except BTLEException as ex:
             print_exception(ex)
             sys.exit(1)
@@ -266,3 +404,7 @@ if __name__ == '__main__':
         except BTLEException as ex:
             print_exception(ex)
             sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()